@@ -4,6 +4,7 @@
 # You should have received a copy of the GNU Affero General Public License along with this program. If not, see <https://www.gnu.org/licenses/>. 
 
 import os
+import math
 import argparse
 import numpy as np
 
@@ -11,26 +12,30 @@ import torch
 from time import time
 from torch.utils.data import DataLoader, Dataset
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
+from torchvision.io import read_image, ImageReadMode
 from torchvision.utils import save_image
-import kornia.morphology as morph
 from PIL import Image
 from tqdm import tqdm
 
+LOG3 = math.log(3.)
+
+
 class PairedRGBDepthDataset(Dataset):
-    def __init__(self, image_path, depth_path, openni_depth, mask_max_depth, image_height, image_width, device):
+    def __init__(self, image_path, depth_path, openni_depth, mask_max_depth, image_height, image_width):
         self.image_dir = image_path
         self.depth_dir = depth_path
         self.image_files = sorted(os.listdir(image_path))
         self.depth_files = sorted(os.listdir(depth_path))
-        self.device = device
         self.openni_depth = openni_depth
         self.mask_max_depth = mask_max_depth
         self.crop = (0, 0, image_height, image_width)
         self.depth_perc = 0.0001
-        self.kernel = torch.ones(3, 3).to(device=device)
+        self.image_resize = transforms.Resize((self.crop[2], self.crop[3]), transforms.InterpolationMode.BILINEAR,
+                                              antialias=True)
         self.image_transforms = transforms.Compose([
-            transforms.Resize((self.crop[2], self.crop[3]), transforms.InterpolationMode.BILINEAR, antialias=True),
+            self.image_resize,
             transforms.PILToTensor(),
         ])
         assert len(self.image_files) == len(self.depth_files)
@@ -38,22 +43,46 @@ class PairedRGBDepthDataset(Dataset):
     def __len__(self):
         return len(self.image_files)
 
+    def load_image(self, path):
+        # JPEG and PNG are decoded straight to a tensor by torchvision, skipping PIL; other formats still use PIL
+        if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg', '.png'):
+            return self.image_resize(read_image(path, ImageReadMode.RGB))
+        return self.image_transforms(Image.open(path))
+
     def __getitem__(self, index):
         fname = self.image_files[index]
-        image = Image.open(os.path.join(self.image_dir, fname))
         depth_fname = self.depth_files[index]
         depth = Image.open(os.path.join(self.depth_dir, depth_fname))
-        depth_transformed: torch.Tensor = self.image_transforms(depth).float().to(device=self.device)
+        depth_transformed: torch.Tensor = self.image_transforms(depth).float()
         if self.openni_depth:
             depth_transformed = depth_transformed / 1000.
         if self.mask_max_depth:
             depth_transformed[depth_transformed == 0.] = depth_transformed.max()
-        low, high = torch.nanquantile(depth_transformed, self.depth_perc), torch.nanquantile(depth_transformed,
-                                                                                             1. - self.depth_perc)
-        depth_transformed[(depth_transformed < low) | (depth_transformed > high)] = 0.
-        depth_transformed = torch.squeeze(morph.closing(torch.unsqueeze(depth_transformed, dim=0), self.kernel), dim=0)
-        left_transformed: torch.Tensor = self.image_transforms(image).to(device=self.device) / 255.
-        return left_transformed, depth_transformed, [fname]
+        # Both thresholds come from a single partition of the depth values
+        low, high = np.nanquantile(depth_transformed.numpy(), [self.depth_perc, 1. - self.depth_perc]).tolist()
+        depth_transformed.masked_fill_(depth_transformed.lt(low).logical_or_(depth_transformed.gt(high)), 0.)
+        # 3x3 morphological closing: dilation (max pool) followed by erosion (negated max pool of the negation)
+        closed_depth = F.max_pool2d(torch.unsqueeze(depth_transformed, dim=0), 3, stride=1, padding=1)
+        closed_depth = -F.max_pool2d(-closed_depth, 3, stride=1, padding=1)
+        depth_transformed = torch.squeeze(closed_depth, dim=0)
+        left_transformed: torch.Tensor = self.load_image(os.path.join(self.image_dir, fname)) / 255.
+        return left_transformed, depth_transformed, fname
+
+
+def depth_conv(depth, conv):
+    # A bias-free 1x1 convolution of single-channel depth is a per-channel scale, so broadcast it instead of running a
+    # convolution. The Conv2d modules are kept so that saved weights still load.
+    return depth * conv.weight.squeeze(1)
+
+
+@torch.jit.script
+def backscatter_fuse(beta_b_conv, beta_d_conv, B_inf, J_prime, pos_mask, image):
+    # Pointwise part of BackscatterNet, scripted so the chain can be fused into few kernels
+    Bc = B_inf * (1 - torch.exp(-torch.relu(beta_b_conv))) + J_prime * torch.exp(-torch.relu(beta_d_conv))
+    backscatter = torch.sigmoid(Bc)
+    # The single-channel mask broadcasts over the colour channels
+    direct = image - backscatter * pos_mask
+    return direct, backscatter
 
 
 class BackscatterNet(nn.Module):
@@ -68,14 +97,9 @@ class BackscatterNet(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.relu = nn.ReLU()
 
-    def forward(self, image, depth):
-        beta_b_conv = self.relu(self.backscatter_conv(depth))
-        beta_d_conv = self.relu(self.residual_conv(depth))
-        Bc = self.B_inf * (1 - torch.exp(-beta_b_conv)) + self.J_prime * torch.exp(-beta_d_conv)
-        backscatter = self.sigmoid(Bc)
-        backscatter_masked = backscatter * (depth > 0.).repeat(1, 3, 1, 1)
-        direct = image - backscatter_masked
-        return direct, backscatter
+    def forward(self, image, depth, pos_mask):
+        return backscatter_fuse(depth_conv(depth, self.backscatter_conv), depth_conv(depth, self.residual_conv),
+                                self.B_inf, self.J_prime, pos_mask, image)
 
 
 class DeattenuateNet(nn.Module):
@@ -88,19 +112,21 @@ class DeattenuateNet(nn.Module):
         self.wb = nn.Parameter(torch.rand(1, 1, 1))
         nn.init.constant_(self.wb, 1)
         self.output_act = nn.Sigmoid()
+        # Running count of NaNs zeroed in J, kept on the device so that forward never synchronizes
+        self.register_buffer('nan_count', torch.zeros((), dtype=torch.long), persistent=False)
 
-    def forward(self, direct, depth):
-        attn_conv = torch.exp(-self.relu(self.attenuation_conv(depth)))
-        beta_d = torch.stack(tuple(
-            torch.sum(attn_conv[:, i:i + 2, :, :] * self.relu(self.attenuation_coef[i:i + 2]), dim=1) for i in
-            range(0, 6, 2)), dim=1)
-        f = torch.exp(torch.clamp(beta_d * depth, 0, float(torch.log(torch.tensor([3.])))))
-        f_masked = f * ((depth == 0.) / f + (depth > 0.))
+    def forward(self, direct, depth, pos_mask):
+        attn_conv = torch.exp(-self.relu(depth_conv(depth, self.attenuation_conv)))
+        # Each output channel is a weighted sum of two consecutive attenuation channels
+        attn_coef = self.relu(self.attenuation_coef).view(3, 2, 1, 1)
+        beta_d = torch.sum(attn_conv.unflatten(1, (3, 2)) * attn_coef, dim=2)
+        f = torch.exp(torch.clamp(beta_d * depth, 0., LOG3))
+        # No attenuation correction where depth is unknown
+        f_masked = torch.where(pos_mask, f, 1.)
         J = f_masked * direct * self.wb
         nanmask = torch.isnan(J)
-        if torch.any(nanmask):
-            print("Warning! NaN values in J")
-            J[nanmask] = 0
+        self.nan_count += nanmask.sum()
+        J = torch.where(nanmask, 0., J)
         return f_masked, J
 
 
@@ -112,10 +138,13 @@ class BackscatterLoss(nn.Module):
         self.mse = nn.MSELoss()
         self.relu = nn.ReLU()
         self.cost_ratio = cost_ratio
+        self.register_buffer('_zero', torch.zeros(1), persistent=False)
 
     def forward(self, direct):
-        pos = self.l1(self.relu(direct), torch.zeros_like(direct))
-        neg = self.smooth_l1(self.relu(-direct), torch.zeros_like(direct))
+        # Expanding the zero buffer gives the loss targets without allocating a full-size tensor
+        zero = self._zero.expand_as(direct)
+        pos = self.l1(self.relu(direct), zero)
+        neg = self.smooth_l1(self.relu(-direct), zero)
         bs_loss = self.cost_ratio * neg + pos
         return bs_loss
 
@@ -143,6 +172,16 @@ class DeattenuateLoss(nn.Module):
         return saturation_loss + intensity_loss + spatial_variation_loss
 
 
+@torch.jit.script
+def znorm_clip(direct, min_mean):
+    # Clips each channel of direct to within 5 standard deviations of its mean, then shifts it so that the mean is at
+    # least min_mean. Equivalent to clamping the z-score to [-5, 5] and rescaling, without materialising the z-scores.
+    mean = direct.mean(dim=[2, 3], keepdim=True)
+    std = direct.std(dim=[2, 3], keepdim=True)
+    clipped = torch.clamp(direct - mean, -5 * std, 5 * std)
+    return torch.clamp(clipped + torch.maximum(mean, min_mean), 0, 1)
+
+
 def main(args):
     seed = int(torch.randint(9223372036854775807, (1,))[0]) if args.seed is None else args.seed
     if args.seed is None:
@@ -151,11 +190,14 @@ def main(args):
     torch.autograd.set_detect_anomaly(True)
 
     train_dataset = PairedRGBDepthDataset(args.images, args.depth, args.depth_16u, args.mask_max_depth, args.height,
-                                             args.width, args.device)
+                                             args.width)
     save_dir = args.output
     os.makedirs(save_dir, exist_ok=True)
     target_batch_size = args.batch_size
-    dataloader = DataLoader(train_dataset, batch_size=target_batch_size, shuffle=True)
+    use_cuda = torch.device(args.device).type == 'cuda'
+    dataloader = DataLoader(train_dataset, batch_size=target_batch_size, shuffle=True,
+                            num_workers=args.num_workers, pin_memory=use_cuda,
+                            persistent_workers=args.num_workers > 0, prefetch_factor=2 if args.num_workers > 0 else None)
     bs_model = BackscatterNet().to(device=args.device)
     da_model = DeattenuateNet().to(device=args.device)
     bs_criterion = BackscatterLoss().to(device=args.device)
@@ -167,25 +209,21 @@ def main(args):
     
     bs_optimizer = torch.optim.Adam(bs_model.parameters(), lr=args.init_lr)
     da_optimizer = torch.optim.Adam(da_model.parameters(), lr=args.init_lr)
-    skip_right = True
+    min_direct_mean = torch.tensor(1. / 255, device=args.device)
     for i in range(args.epochs):
         total_bs_loss = 0
         total_da_loss = 0
         for (left, depth, fnames) in tqdm(dataloader):
-            image_batch = left
-            batch_size = image_batch.shape[0]
-            direct, _ = bs_model(image_batch, depth)
+            image_batch = left.to(args.device, non_blocking=True)
+            depth = depth.to(args.device, non_blocking=True)
+            pos_mask = depth > 0.
+            direct, _ = bs_model(image_batch, depth, pos_mask)
             bs_loss = bs_criterion(direct)
             bs_optimizer.zero_grad()
             bs_loss.backward()
             bs_optimizer.step()
-            direct_mean = direct.mean(dim=[2, 3], keepdim=True)
-            direct_std = direct.std(dim=[2, 3], keepdim=True)
-            direct_z = (direct - direct_mean) / direct_std
-            clamped_z = torch.clamp(direct_z, -5, 5)
-            direct_no_grad = torch.clamp(
-            (clamped_z * direct_std) + torch.maximum(direct_mean, torch.Tensor([1. / 255]).to(device=args.device)), 0, 1).detach()
-            f, J = da_model(direct_no_grad, depth)
+            direct_no_grad = znorm_clip(direct, min_direct_mean).detach()
+            f, J = da_model(direct_no_grad, depth, pos_mask)
             da_loss = da_criterion(direct_no_grad, J)
             da_optimizer.zero_grad()
             da_loss.backward()
@@ -193,15 +231,15 @@ def main(args):
             total_bs_loss += bs_loss.item()
             total_da_loss += da_loss.item()
             J_img = torch.clamp(J, 0., 1.).cpu()
-            for side in range(1 if skip_right else 2):
-                names = fnames[side]
-                for n in range(batch_size):
-                    i = n + target_batch_size * side
-                    # save_image(J_img[i], "%s/%s-corrected.png" % (save_dir, names[n].rstrip('.png')))
+            # for n, fname in enumerate(fnames):
+            #     save_image(J_img[n], "%s/%s-corrected.png" % (save_dir, fname.rstrip('.png')))
         
         total_bs_loss /= len(dataloader)
         total_da_loss /= len(dataloader)
         print("Losses: %.9f %.9f" % (total_bs_loss, total_da_loss))
+        if da_model.nan_count:
+            print("Warning! %d NaN values in J" % int(da_model.nan_count))
+            da_model.nan_count.zero_()
         
         torch.save(bs_model.cpu().state_dict(), '%s/bs_model.pt' % save_dir)
         torch.save(da_model.cpu().state_dict(), '%s/da_model.pt' % save_dir)
@@ -226,6 +264,8 @@ if __name__ == '__main__':
     parser.add_argument('--save_intermediates', action='store_true', default=False, help='Set to True to save intermediate files (backscatter, attenuation, and direct images)')
     parser.add_argument('--epochs', type=int, default=50, help='How many epochs')
     parser.add_argument('--init_lr', type=float, default=1e-2, help='Initial learning rate for Adam optimizer')
+    parser.add_argument('--num_workers', type=int, default=max(4, (os.cpu_count() or 0) // 2),
+                        help='Number of DataLoader worker processes used to load and preprocess images')
     parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
     parser.add_argument('--bs_weights', type=str, default=None, help='BS Model weights to re-train')
     parser.add_argument('--da_weights', type=str, default=None, help='DA Model weights to re-train')
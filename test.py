@@ -4,36 +4,43 @@
 # You should have received a copy of the GNU Affero General Public License along with this program. If not, see <https://www.gnu.org/licenses/>. 
 
 import os
+import math
 import argparse
 import numpy as np
 
 import torch
 from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from torch.utils.data import DataLoader, Dataset
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.transforms as transforms
-from torchvision.utils import save_image
-import kornia.morphology as morph
+from torchvision.io import read_image, ImageReadMode
+from torchvision.io import write_png
 from PIL import Image
 try:
     from tqdm import trange
 except:
     trange = range
 
+LOG3 = math.log(3.)
+
+
 class PairedRGBDepthDataset(Dataset):
-    def __init__(self, image_path, depth_path, openni_depth, mask_max_depth, image_height, image_width, device):
+    def __init__(self, image_path, depth_path, openni_depth, mask_max_depth, image_height, image_width):
         self.image_dir = image_path
         self.depth_dir = depth_path
         self.image_files = sorted(os.listdir(image_path))
         self.depth_files = sorted(os.listdir(depth_path))
-        self.device = device
         self.openni_depth = openni_depth
         self.mask_max_depth = mask_max_depth
         self.crop = (0, 0, image_height, image_width)
         self.depth_perc = 0.0001
-        self.kernel = torch.ones(3, 3).to(device=device)
+        self.image_resize = transforms.Resize((self.crop[2], self.crop[3]), transforms.InterpolationMode.BILINEAR,
+                                              antialias=True)
         self.image_transforms = transforms.Compose([
-            transforms.Resize((self.crop[2], self.crop[3]), transforms.InterpolationMode.BILINEAR, antialias=True),
+            self.image_resize,
             transforms.PILToTensor(),
         ])
         assert len(self.image_files) == len(self.depth_files)
@@ -41,22 +48,46 @@ class PairedRGBDepthDataset(Dataset):
     def __len__(self):
         return len(self.image_files)
 
+    def load_image(self, path):
+        # JPEG and PNG are decoded straight to a tensor by torchvision, skipping PIL; other formats still use PIL
+        if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg', '.png'):
+            return self.image_resize(read_image(path, ImageReadMode.RGB))
+        return self.image_transforms(Image.open(path))
+
     def __getitem__(self, index):
         fname = self.image_files[index]
-        image = Image.open(os.path.join(self.image_dir, fname))
         depth_fname = self.depth_files[index]
         depth = Image.open(os.path.join(self.depth_dir, depth_fname))
-        depth_transformed: torch.Tensor = self.image_transforms(depth).float().to(device=self.device)
+        depth_transformed: torch.Tensor = self.image_transforms(depth).float()
         if self.openni_depth:
             depth_transformed = depth_transformed / 1000.
         if self.mask_max_depth:
             depth_transformed[depth_transformed == 0.] = depth_transformed.max()
-        low, high = torch.nanquantile(depth_transformed, self.depth_perc), torch.nanquantile(depth_transformed,
-                                                                                             1. - self.depth_perc)
-        depth_transformed[(depth_transformed < low) | (depth_transformed > high)] = 0.
-        depth_transformed = torch.squeeze(morph.closing(torch.unsqueeze(depth_transformed, dim=0), self.kernel), dim=0)
-        left_transformed: torch.Tensor = self.image_transforms(image).to(device=self.device) / 255.
-        return left_transformed, depth_transformed, [fname]
+        # Both thresholds come from a single partition of the depth values
+        low, high = np.nanquantile(depth_transformed.numpy(), [self.depth_perc, 1. - self.depth_perc]).tolist()
+        depth_transformed.masked_fill_(depth_transformed.lt(low).logical_or_(depth_transformed.gt(high)), 0.)
+        # 3x3 morphological closing: dilation (max pool) followed by erosion (negated max pool of the negation)
+        closed_depth = F.max_pool2d(torch.unsqueeze(depth_transformed, dim=0), 3, stride=1, padding=1)
+        closed_depth = -F.max_pool2d(-closed_depth, 3, stride=1, padding=1)
+        depth_transformed = torch.squeeze(closed_depth, dim=0)
+        left_transformed: torch.Tensor = self.load_image(os.path.join(self.image_dir, fname)) / 255.
+        return left_transformed, depth_transformed, fname
+
+
+def depth_conv(depth, conv):
+    # A bias-free 1x1 convolution of single-channel depth is a per-channel scale, so broadcast it instead of running a
+    # convolution. The Conv2d modules are kept so that saved weights still load.
+    return depth * conv.weight.squeeze(1)
+
+
+@torch.jit.script
+def backscatter_fuse(beta_b_conv, beta_d_conv, B_inf, J_prime, pos_mask, image):
+    # Pointwise part of BackscatterNet, scripted so the chain can be fused into few kernels
+    Bc = B_inf * (1 - torch.exp(-torch.relu(beta_b_conv))) + J_prime * torch.exp(-torch.relu(beta_d_conv))
+    backscatter = torch.sigmoid(Bc)
+    # The single-channel mask broadcasts over the colour channels
+    direct = image - backscatter * pos_mask
+    return direct, backscatter
 
 
 class BackscatterNet(nn.Module):
@@ -71,14 +102,9 @@ class BackscatterNet(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.relu = nn.ReLU()
 
-    def forward(self, image, depth):
-        beta_b_conv = self.relu(self.backscatter_conv(depth))
-        beta_d_conv = self.relu(self.residual_conv(depth))
-        Bc = self.B_inf * (1 - torch.exp(-beta_b_conv)) + self.J_prime * torch.exp(-beta_d_conv)
-        backscatter = self.sigmoid(Bc)
-        backscatter_masked = backscatter * (depth > 0.).repeat(1, 3, 1, 1)
-        direct = image - backscatter_masked
-        return direct, backscatter
+    def forward(self, image, depth, pos_mask):
+        return backscatter_fuse(depth_conv(depth, self.backscatter_conv), depth_conv(depth, self.residual_conv),
+                                self.B_inf, self.J_prime, pos_mask, image)
 
 
 class DeattenuateNet(nn.Module):
@@ -91,19 +117,21 @@ class DeattenuateNet(nn.Module):
         self.wb = nn.Parameter(torch.rand(1, 1, 1))
         nn.init.constant_(self.wb, 1)
         self.output_act = nn.Sigmoid()
+        # Running count of NaNs zeroed in J, kept on the device so that forward never synchronizes
+        self.register_buffer('nan_count', torch.zeros((), dtype=torch.long), persistent=False)
 
-    def forward(self, direct, depth):
-        attn_conv = torch.exp(-self.relu(self.attenuation_conv(depth)))
-        beta_d = torch.stack(tuple(
-            torch.sum(attn_conv[:, i:i + 2, :, :] * self.relu(self.attenuation_coef[i:i + 2]), dim=1) for i in
-            range(0, 6, 2)), dim=1)
-        f = torch.exp(torch.clamp(beta_d * depth, 0, float(torch.log(torch.tensor([3.])))))
-        f_masked = f * ((depth == 0.) / f + (depth > 0.))
+    def forward(self, direct, depth, pos_mask):
+        attn_conv = torch.exp(-self.relu(depth_conv(depth, self.attenuation_conv)))
+        # Each output channel is a weighted sum of two consecutive attenuation channels
+        attn_coef = self.relu(self.attenuation_coef).view(3, 2, 1, 1)
+        beta_d = torch.sum(attn_conv.unflatten(1, (3, 2)) * attn_coef, dim=2)
+        f = torch.exp(torch.clamp(beta_d * depth, 0., LOG3))
+        # No attenuation correction where depth is unknown
+        f_masked = torch.where(pos_mask, f, 1.)
         J = f_masked * direct * self.wb
         nanmask = torch.isnan(J)
-        if torch.any(nanmask):
-            print("Warning! NaN values in J")
-            J[nanmask] = 0
+        self.nan_count += nanmask.sum()
+        J = torch.where(nanmask, 0., J)
         return f_masked, J
 
 
@@ -115,10 +143,13 @@ class BackscatterLoss(nn.Module):
         self.mse = nn.MSELoss()
         self.relu = nn.ReLU()
         self.cost_ratio = cost_ratio
+        self.register_buffer('_zero', torch.zeros(1), persistent=False)
 
     def forward(self, direct):
-        pos = self.l1(self.relu(direct), torch.zeros_like(direct))
-        neg = self.smooth_l1(self.relu(-direct), torch.zeros_like(direct))
+        # Expanding the zero buffer gives the loss targets without allocating a full-size tensor
+        zero = self._zero.expand_as(direct)
+        pos = self.l1(self.relu(direct), zero)
+        neg = self.smooth_l1(self.relu(-direct), zero)
         bs_loss = self.cost_ratio * neg + pos
         return bs_loss
 
@@ -146,53 +177,167 @@ class DeattenuateLoss(nn.Module):
         return saturation_loss + intensity_loss + spatial_variation_loss
 
 
+def to_uint8(images):
+    # Same rounding as torchvision.utils.save_image, done on the device so only bytes are copied back
+    return images.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8).contiguous()
+
+
+@torch.jit.script
+def znorm_clip(direct, min_mean):
+    # Clips each channel of direct to within 5 standard deviations of its mean, then shifts it so that the mean is at
+    # least min_mean. Equivalent to clamping the z-score to [-5, 5] and rescaling, without materialising the z-scores.
+    mean = direct.mean(dim=[2, 3], keepdim=True)
+    std = direct.std(dim=[2, 3], keepdim=True)
+    clipped = torch.clamp(direct - mean, -5 * std, 5 * std)
+    return torch.clamp(clipped + torch.maximum(mean, min_mean), 0, 1)
+
+
+class EvalTimer:
+    # Accumulates the device time spent between start() and stop(). On CUDA this uses events, which are only read back
+    # in total_ms() so timing does not add a synchronization to every batch.
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.intervals = []
+        self.started = None
+
+    def now(self):
+        if not self.use_cuda:
+            return time()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(torch.cuda.current_stream(self.device))
+        return event
+
+    def start(self):
+        self.started = self.now()
+
+    def stop(self):
+        self.intervals.append((self.started, self.now()))
+
+    def total_ms(self):
+        if not self.use_cuda:
+            return sum(end - start for start, end in self.intervals) * 1000.
+        torch.cuda.synchronize(self.device)
+        return sum(start.elapsed_time(end) for start, end in self.intervals)
+
+
+def copy_to_host(tensors, copy_stream):
+    # Starts device-to-host copies on copy_stream so they overlap with the next batch's compute. Returns the host
+    # tensors and an event that must be synchronized before reading them (None if the copies were synchronous).
+    if copy_stream is None:
+        return [t.cpu() for t in tensors], None
+    copy_stream.wait_stream(torch.cuda.current_stream(copy_stream.device))
+    host_tensors = []
+    with torch.cuda.stream(copy_stream):
+        for t in tensors:
+            t.record_stream(copy_stream)
+            # A non-blocking device-to-host copy allocates a pinned destination
+            host_tensors.append(t.to('cpu', non_blocking=True))
+        done = torch.cuda.Event()
+        done.record(copy_stream)
+    return host_tensors, done
+
+
+def save_images(images, paths, done=None):
+    if done is not None:
+        done.synchronize()
+    for image, path in zip(images, paths):
+        write_png(image, path, compression_level=3)
+
+
 def main(args):
     train_dataset = PairedRGBDepthDataset(args.images, args.depth, args.depth_16u, args.mask_max_depth, args.height,
-                                             args.width, args.device)
+                                             args.width)
     save_dir = args.output
     os.makedirs(save_dir, exist_ok=True)
-    target_batch_size = 1
-    dataloader = DataLoader(train_dataset, batch_size=target_batch_size, shuffle=False)
+    target_batch_size = args.batch_size
+    use_cuda = torch.device(args.device).type == 'cuda'
+    # The networks are purely pointwise, which autocast leaves in fp32, so --amp casts the weights and inputs instead
+    if not args.amp:
+        model_dtype = torch.float32
+    elif not use_cuda or torch.cuda.is_bf16_supported():
+        model_dtype = torch.bfloat16
+    else:
+        model_dtype = torch.float16
+    dataloader = DataLoader(train_dataset, batch_size=target_batch_size, shuffle=False,
+                            num_workers=args.num_workers, pin_memory=use_cuda,
+                            persistent_workers=args.num_workers > 0, prefetch_factor=2 if args.num_workers > 0 else None)
     bs_model = BackscatterNet().to(device=args.device)
     da_model = DeattenuateNet().to(device=args.device)
     
     bs_model.load_state_dict(torch.load(args.bs_weights))
     da_model.load_state_dict(torch.load(args.da_weights))
+    bs_model.to(dtype=model_dtype)
+    da_model.to(dtype=model_dtype)
+    bs_model.eval()
+    da_model.eval()
+
+    if args.compile:
+        bs_model = torch.compile(bs_model)
+        da_model = torch.compile(da_model)
+        # Trigger compilation before the timed loop
+        warmup_image = torch.zeros(target_batch_size, 3, args.height, args.width, device=args.device,
+                                   dtype=model_dtype).to(memory_format=torch.channels_last)
+        warmup_depth = torch.zeros(target_batch_size, 1, args.height, args.width, device=args.device,
+                                   dtype=model_dtype).to(memory_format=torch.channels_last)
+        warmup_mask = warmup_depth > 0.
+        # Match the loop's grad mode and dtypes so the compiled graphs are reused rather than recompiled
+        with torch.inference_mode():
+            for _ in range(3):
+                warmup_direct, _ = bs_model(warmup_image, warmup_depth, warmup_mask)
+                da_model(warmup_direct, warmup_depth, warmup_mask)
     
-    skip_right = True
-    total_bs_eval_time = 0.
-    total_at_eval_time = 0.
-    for j, (left, depth, fnames) in enumerate(dataloader):
-        image_batch = left
-        start = time()
-        direct, backscatter = bs_model(image_batch, depth)
-        total_bs_eval_time = time() - start
-        direct_mean = direct.mean(dim=[2, 3], keepdim=True)
-        direct_std = direct.std(dim=[2, 3], keepdim=True)
-        direct_z = (direct - direct_mean) / direct_std
-        clamped_z = torch.clamp(direct_z, -5, 5)
-        direct_no_grad = torch.clamp(
-            (clamped_z * direct_std) + torch.maximum(direct_mean, torch.Tensor([1. / 255]).to(device=args.device)), 0, 1).detach()
-        start = time()
-        f, J = da_model(direct_no_grad, depth)
-        total_at_eval_time = time() - start
-        total_time = total_bs_eval_time + total_at_eval_time
-        print("Avg time per eval: %f ms (%f ms bs, %f ms at)" % (total_time, total_bs_eval_time, total_at_eval_time))
-        direct_img = torch.clamp(direct_no_grad, 0., 1.).cpu()
-        backscatter_img = torch.clamp(backscatter, 0., 1.).detach().cpu()
-        f_img = f.detach().cpu()
-        f_img = f_img / f_img.max()
-        J_img = torch.clamp(J, 0., 1.).cpu()
-        for side in range(1 if skip_right else 2):
-            names = fnames[side]
-            for n in range(1):
-                i = n + target_batch_size * side
-                if args.save_intermediates:
-                    save_image(direct_img[i], "%s/%s-direct.png" % (save_dir, names[n].rstrip('.png')))
-                    save_image(backscatter_img[i], "%s/%s-backscatter.png" % (save_dir, names[n].rstrip('.png')))
-                    save_image(f_img[i], "%s/%s-f.png" % (save_dir, names[n].rstrip('.png')))
-                save_image(J_img[i], "%s/%s-corrected.png" % (save_dir, names[n].rstrip('.png')))
-        
+    copy_stream = torch.cuda.Stream(device=args.device) if use_cuda else None
+    io_workers = 4
+    io_pool = ThreadPoolExecutor(max_workers=io_workers)
+    pending_saves = deque()
+    bs_timer = EvalTimer(args.device)
+    at_timer = EvalTimer(args.device)
+    min_direct_mean = torch.tensor(1. / 255, device=args.device)
+    for left, depth, fnames in dataloader:
+        with torch.inference_mode():
+            image_batch = left.to(args.device, non_blocking=True, memory_format=torch.channels_last).to(model_dtype)
+            depth = depth.to(args.device, non_blocking=True, memory_format=torch.channels_last).to(model_dtype)
+            pos_mask = depth > 0.
+            bs_timer.start()
+            direct, backscatter = bs_model(image_batch, depth, pos_mask)
+            direct, backscatter = direct.float(), backscatter.float()
+            bs_timer.stop()
+            direct_no_grad = znorm_clip(direct, min_direct_mean)
+            at_timer.start()
+            f, J = da_model(direct_no_grad.to(model_dtype), depth, pos_mask)
+            f, J = f.float(), J.float()
+            at_timer.stop()
+            outputs = {'corrected': torch.clamp(J, 0., 1.)}
+            if args.save_intermediates:
+                outputs['direct'] = torch.clamp(direct_no_grad, 0., 1.)
+                outputs['backscatter'] = torch.clamp(backscatter, 0., 1.)
+                outputs['f'] = f / f.amax(dim=[1, 2, 3], keepdim=True)
+            host_outputs, copies_done = copy_to_host([to_uint8(output) for output in outputs.values()], copy_stream)
+        images, paths = [], []
+        for i, fname in enumerate(fnames):
+            name = fname.rstrip('.png')
+            for suffix, host_output in zip(outputs, host_outputs):
+                images.append(host_output[i])
+                paths.append("%s/%s-%s.png" % (save_dir, name, suffix))
+        pending_saves.append(io_pool.submit(save_images, images, paths, copies_done))
+        # Bound the number of batches held in host memory while waiting to be written
+        while len(pending_saves) > 2 * io_workers:
+            pending_saves.popleft().result()
+
+    for pending_save in pending_saves:
+        pending_save.result()
+    io_pool.shutdown()
+    if da_model.nan_count:
+        print("Warning! %d NaN values in J were set to 0" % int(da_model.nan_count))
+
+    num_batches = max(len(dataloader), 1)
+    total_bs_eval_time = bs_timer.total_ms() / num_batches
+    total_at_eval_time = at_timer.total_ms() / num_batches
+    total_time = total_bs_eval_time + total_at_eval_time
+    print("Avg time per eval (batch size %d): %f ms (%f ms bs, %f ms at)" % (
+        target_batch_size, total_time, total_bs_eval_time, total_at_eval_time))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -206,7 +351,14 @@ if __name__ == '__main__':
                         help='True if depth images are 16-bit unsigned (millimetres), false if floating point (metres)')
     parser.add_argument('--mask_max_depth', action='store_true',
                         help='If true will replace zeroes in depth files with max depth')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size for processing images')
     parser.add_argument('--save_intermediates', action='store_true', default=False, help='Set to True to save intermediate files (backscatter, attenuation, and direct images)')
+    parser.add_argument('--num_workers', type=int, default=max(4, (os.cpu_count() or 0) // 2),
+                        help='Number of DataLoader worker processes used to load and preprocess images')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='Set to True to compile the networks with torch.compile (slower startup, faster inference)')
+    parser.add_argument('--amp', action='store_true', default=False,
+                        help='Set to True to run the networks in bfloat16 (or float16 where bfloat16 is unsupported)')
     parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
     parser.add_argument('--bs_weights', type=str, required=True, help='BS Model weights')
     parser.add_argument('--da_weights', type=str, required=True, help='DA Model weights')